@@ -1,10 +1,18 @@
 import os
+import click
 from flask import Flask, request, abort, jsonify
 # from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import random
+from sqlalchemy.exc import SQLAlchemyError
 
-from models import setup_db, Question, Category, User
+from models import setup_db, database_path, database_path_for, \
+    load_psql_dump, refresh_stats, Question, Category, User, QuestionStat, \
+    ScoreStat
+from flaskr.resilience import CircuitBreaker, ResponseCache, \
+    stale_while_revalidate
+from flaskr.formats import response_format, question_rows, \
+    compact_response, compress
 
 QUESTIONS_PER_PAGE = 10
 
@@ -14,16 +22,70 @@ def questions_pagination(request, selection):
     to paginate questions (10 questions per page)
     """
     page = request.args.get('page', 1, type=int)
+    # pages before the first one are empty (instead of slicing from the end)
+    if page < 1:
+        return []
     start = (page - 1) * QUESTIONS_PER_PAGE
     end = start + QUESTIONS_PER_PAGE
     questions = [question.format() for question in selection]
     return questions[start:end]
 
 
+def questions_pagination_rows(request, query):
+    """
+    same page as questions_pagination, as row tuples for the compact formats
+    """
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        return []
+    return question_rows(query, (page - 1) * QUESTIONS_PER_PAGE,
+                         QUESTIONS_PER_PAGE)
+
+
+def read_cache_key(request):
+    """
+    name of the cached response of a read request, built from the page
+    number and the negotiated format rather than the raw query string and
+    Accept header
+    """
+    page = request.args.get('page', 1, type=int)
+    return '{}?page={} ({})'.format(request.path, page,
+                                    response_format(request))
+
+
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    # seconds a read query (and a database connection) can take
+    app.config.setdefault('QUERY_DEADLINE', 2)
+    # DB_PROFILE selects the storage backend: 'postgres', 'sqlite' or 'memory'
+    profile = app.config.get('DB_PROFILE')
+    setup_db(app, database_path_for(profile) if profile else database_path)
+
+    # read endpoints keep serving their last good response while the
+    # database is slow or down, see flaskr/resilience.py
+    breaker = CircuitBreaker(
+        failure_threshold=app.config.get('BREAKER_FAILURE_THRESHOLD', 5),
+        reset_timeout=app.config.get('BREAKER_RESET_TIMEOUT', 30))
+    read_cache = ResponseCache(
+        max_entries=app.config.get('CACHE_MAX_ENTRIES', 256))
+
+    @app.cli.command('load-dump')
+    @click.argument('path', default='trivia.psql')
+    def load_dump(path):
+        """
+        bulk load a pg_dump file (trivia.psql by default) into the database
+        """
+        load_psql_dump(path)
+
+    @app.cli.command('refresh-stats')
+    def refresh_stats_command():
+        """
+        rebuild the /stats summary tables (run it from a scheduled job)
+        """
+        refresh_stats()
 
     """
     Setting up CORS and allow '*' for origins.
@@ -43,12 +105,24 @@ def create_app(test_config=None):
                              'GET,PUT,POST,DELETE,OPTIONS')
         return response
 
+    # gzip/brotli encode responses larger than COMPRESS_MIN_SIZE bytes,
+    # set it to None to disable compression
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+
+    @app.after_request
+    def compress_response(response):
+        # these routes answer in the format negotiated with response_format
+        if request.endpoint in ('get_all_questions', 'questions_per_category'):
+            response.vary.add('Accept')
+        return compress(request, response, app.config['COMPRESS_MIN_SIZE'])
+
 
 # ----------------------------------------------------------------------------#
 # An endpoint to get all available categories .
 # ----------------------------------------------------------------------------#
 
     @app.route("/categories")
+    @stale_while_revalidate(read_cache, breaker, read_cache_key)
     def get_all_categories():
         # query the database to get all categories
         categories_query = Category.query.all()
@@ -72,13 +146,22 @@ def create_app(test_config=None):
 # ----------------------------------------------------------------------------#
 
     @app.route('/questions')
+    @stale_while_revalidate(read_cache, breaker, read_cache_key)
     def get_all_questions():
         try:
-            # get all questions
-            selection = Question.query.order_by(Question.id).all()
+            mimetype = response_format(request)
+            if mimetype == 'application/json':
+                # get all questions
+                selection = Question.query.order_by(Question.id).all()
 
-            # get questions in a page (10 questions per page)
-            paginated_questions = questions_pagination(request, selection)
+                # get questions in a page (10 questions per page)
+                paginated_questions = questions_pagination(request, selection)
+                total_questions = len(selection)
+            else:
+                # compact formats are encoded straight from row tuples
+                paginated_questions = questions_pagination_rows(
+                    request, Question.query)
+                total_questions = Question.query.count()
 
             # if there are questions
             if (len(paginated_questions) != 0):
@@ -88,17 +171,76 @@ def create_app(test_config=None):
                 for category in categories_query:
                     categories_dict[category.id] = category.type
 
+                if mimetype != 'application/json':
+                    return compact_response(
+                        mimetype, paginated_questions,
+                        total_questions=total_questions,
+                        categories=categories_dict)
                 return jsonify({
                     'success': True,
                     'questions': paginated_questions,
-                    'total_questions': len(selection),
+                    'total_questions': total_questions,
                     'categories': categories_dict
                 })
             abort(404)
+        except SQLAlchemyError:
+            # database errors are handled by stale_while_revalidate
+            raise
         except:
             abort(400)
 
 
+# ----------------------------------------------------------------------------#
+# An endpoint to get questions filtered by categories and difficulty range.
+# Pages are walked with an id cursor (the next_cursor of the previous page)
+# instead of page numbers.
+# ----------------------------------------------------------------------------#
+
+    @app.route('/questions/filter')
+    def get_filtered_questions():
+        categories = request.args.get('categories', '')
+        min_difficulty = request.args.get('min_difficulty', None, type=int)
+        max_difficulty = request.args.get('max_difficulty', None, type=int)
+        after = request.args.get('after', '')
+        sort = request.args.get('sort', 'id')
+
+        try:
+            # categories are sent as a comma separated list of ids
+            categories = [int(category)
+                          for category in categories.split(',') if category]
+            # the cursor is "id", or "difficulty:id" for the difficulty sorts
+            cursor = [int(value) for value in after.split(':')] if after \
+                else []
+            if len(cursor) > 2:
+                abort(400)
+            after_difficulty = cursor[0] if len(cursor) == 2 else None
+            after_id = cursor[-1] if cursor else None
+            selection = Question.filtered(
+                categories=categories,
+                min_difficulty=min_difficulty,
+                max_difficulty=max_difficulty,
+                after_id=after_id,
+                after_difficulty=after_difficulty,
+                sort=sort).limit(QUESTIONS_PER_PAGE).all()
+        except ValueError:
+            abort(400)
+
+        questions = [question.format() for question in selection]
+        next_cursor = None
+        if len(questions) == QUESTIONS_PER_PAGE:
+            last = questions[-1]
+            # the cursor carries everything needed to resume, so the next
+            # page does not depend on the last question still existing
+            next_cursor = str(last['id'])
+            if sort.lstrip('-') == 'difficulty':
+                next_cursor = '{}:{}'.format(last['difficulty'], last['id'])
+        return jsonify({
+            'success': True,
+            'questions': questions,
+            # cursor to send as "after" to get the next page
+            'next_cursor': next_cursor,
+        })
+
 # ----------------------------------------------------------------------------#
 # An endpoint to delete existing question
 # ----------------------------------------------------------------------------#
@@ -201,13 +343,23 @@ def create_app(test_config=None):
 # ----------------------------------------------------------------------------#
 
     @ app.route("/categories/<int:category_id>/questions")
+    @stale_while_revalidate(read_cache, breaker, read_cache_key)
     def questions_per_category(category_id):
         # query the database for category with the given id
         category = Category.query.filter_by(id=category_id).one_or_none()
         if category is not None:
+            mimetype = response_format(request)
+            if mimetype != 'application/json':
+                # compact formats are encoded straight from row tuples
+                query = Question.query.filter_by(category=category_id)
+                return compact_response(
+                    mimetype, questions_pagination_rows(request, query),
+                    total_questions=query.count(),
+                    current_category=category.type)
+
             # query the database to get all questions of that category
             questions_per_category = Question.query.filter_by(
-                category=str(category_id)).all()
+                category=category_id).all()
 
             # if there are questions paginate them
             if questions_per_category is not None:
@@ -243,6 +395,14 @@ def create_app(test_config=None):
         # added to pick the score
         correct_answer = body.get('num_correct')
         forceEnd = body.get('forceEnd')
+        # optional difficulty range of the quiz, sent as numbers or strings
+        try:
+            min_difficulty, max_difficulty = [
+                None if value is None else int(value)
+                for value in (body.get('min_difficulty'),
+                              body.get('max_difficulty'))]
+        except (TypeError, ValueError):
+            abort(422)
 
         # CHALLENGE 3
         # query the database to get the last user id
@@ -266,14 +426,16 @@ def create_app(test_config=None):
         try:
             # if user picked 'ALL' categories
             if category['type'] == 'click':
-                # filter available questions
-                available_questions = Question.query.filter(
-                    Question.id.notin_((previous_questions))).all()
+                categories = None
             else:
-                # filter available questions per category and eliminate used questions
-                available_questions = Question.query.filter_by(
-                    category=category['id']).filter(
-                        Question.id.notin_((previous_questions))).all()
+                categories = [category['id']]
+            # filter available questions per category and difficulty
+            # and eliminate used questions
+            available_questions = Question.filtered(
+                categories=categories,
+                min_difficulty=min_difficulty,
+                max_difficulty=max_difficulty).filter(
+                    Question.id.notin_((previous_questions))).all()
 
             # select next question from available questions randomly using random.randrange
             new_question = available_questions[random.randrange(
@@ -354,7 +516,7 @@ def create_app(test_config=None):
 # ----------------------------------------------------------------------------#
 
 
-    @app.route('/users/<int:users_id>', methods=['DELETE'])
+    @app.route('/users/<int:user_id>', methods=['DELETE'])
     def delete_user(user_id):
         user = User.query.filter_by(id=user_id).one_or_none()
         if user is not None:
@@ -369,6 +531,57 @@ def create_app(test_config=None):
             except:
                 abort(422)
         abort(404)
+
+# ----------------------------------------------------------------------------#
+# An endpoint to get aggregate statistics about questions and players.
+# Served from the summary tables so the cost does not grow with the number
+# of questions or users.
+# ----------------------------------------------------------------------------#
+
+    @app.route('/stats')
+    def get_stats():
+        # per category and per difficulty counters
+        questions_per_category = {}
+        difficulty_distribution = {}
+        for stat in QuestionStat.query.filter(QuestionStat.count > 0).all():
+            questions_per_category[stat.category] = questions_per_category.get(
+                stat.category, 0) + stat.count
+            difficulty_distribution[stat.difficulty] = difficulty_distribution.get(
+                stat.difficulty, 0) + stat.count
+
+        # players score histogram and average
+        score_histogram = {}
+        for stat in ScoreStat.query.filter(ScoreStat.count > 0).order_by(
+                ScoreStat.score).all():
+            score_histogram[stat.score] = stat.count
+        total_users = sum(score_histogram.values())
+        total_score = sum(score * count for score,
+                          count in score_histogram.items())
+
+        return jsonify({
+            'success': True,
+            'total_questions': sum(questions_per_category.values()),
+            'questions_per_category': questions_per_category,
+            'difficulty_distribution': difficulty_distribution,
+            'total_users': total_users,
+            'score_histogram': score_histogram,
+            'average_score': total_score / total_users if total_users else 0,
+        })
+
+
+# ----------------------------------------------------------------------------#
+# An endpoint to get the state of the read cache and of the circuit breaker
+# ----------------------------------------------------------------------------#
+
+    @app.route('/metrics')
+    def get_metrics():
+        return jsonify({
+            'success': True,
+            'circuit_breaker': breaker.format(),
+            'cache': read_cache.format(),
+        })
+
+
 # ----------------------------------------------------------------------------#
 # CHALLENGE 3: add category
 # ----------------------------------------------------------------------------#
@@ -433,6 +646,14 @@ def create_app(test_config=None):
             "message": "Internal server error"
         }), 500
 
+    @ app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            "success": False,
+            'error': 503,
+            "message": "Service unavailable"
+        }), 503
+
     @ app.errorhandler(405)
     def invalid_method(error):
         return jsonify({
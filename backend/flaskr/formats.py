@@ -0,0 +1,89 @@
+import gzip
+import json
+
+from flask import make_response
+
+# msgpack and brotli are optional, the formats they provide are only
+# offered when they are installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from models import Question
+
+# compact formats: field names are sent once in "fields" and each
+# question is an array of values in the same order in "rows"
+COLUMNAR_MIMETYPE = 'application/vnd.trivia.columnar+json'
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+QUESTION_COLUMNS = tuple(getattr(Question, field) for field in QUESTION_FIELDS)
+
+
+def response_format(request):
+    """
+        pick the response mimetype from the Accept header, plain JSON unless
+        the client prefers one of the compact formats
+    """
+    offers = ['application/json', COLUMNAR_MIMETYPE]
+    if msgpack is not None:
+        offers.append(MSGPACK_MIMETYPE)
+    if not request.accept_mimetypes.provided:
+        return 'application/json'
+    return request.accept_mimetypes.best_match(
+        offers, default='application/json')
+
+
+def question_rows(query, start, limit):
+    """
+        page of questions as plain row tuples in QUESTION_FIELDS order,
+        without loading Question objects
+    """
+    return query.with_entities(*QUESTION_COLUMNS).order_by(
+        Question.id).offset(start).limit(limit).all()
+
+
+def compact_response(mimetype, rows, **payload):
+    """
+        encode the question rows and the rest of the payload in one of the
+        compact formats
+    """
+    payload['success'] = True
+    payload['questions'] = {
+        'fields': QUESTION_FIELDS,
+        'rows': [tuple(row) for row in rows],
+    }
+    if mimetype == MSGPACK_MIMETYPE:
+        response = make_response(msgpack.packb(payload))
+    else:
+        response = make_response(json.dumps(payload, separators=(',', ':')))
+    response.mimetype = mimetype
+    return response
+
+
+def compress(request, response, min_size):
+    """
+        gzip or brotli encode the response body when it is larger than
+        min_size bytes and the client accepts it
+    """
+    response.vary.add('Accept-Encoding')
+    if min_size is None or response.direct_passthrough or \
+            response.status_code != 200 or \
+            'Content-Encoding' in response.headers or \
+            response.content_length is None or \
+            response.content_length < min_size:
+        return response
+
+    encodings = request.accept_encodings
+    if brotli is not None and encodings['br']:
+        response.set_data(brotli.compress(response.get_data()))
+        response.headers['Content-Encoding'] = 'br'
+    elif encodings['gzip']:
+        response.set_data(gzip.compress(response.get_data()))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -0,0 +1,206 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request, abort, make_response
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import HTTPException
+
+from models import db, set_query_deadline, clear_query_deadline
+
+
+class CircuitBreaker:
+    """
+        stop sending queries to the database once failure_threshold
+        consecutive queries failed, and let a single probe through after
+        reset_timeout seconds to find out if it is back
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and \
+                    time.monotonic() - self.opened_at >= self.reset_timeout:
+                # half-open: this caller is the probe, the others wait
+                self.state = 'half-open'
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or \
+                    self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def record_error(self):
+        """
+            the request failed for a reason other than the database: a
+            half-open probe goes back to open without counting a failure
+        """
+        with self.lock:
+            if self.state == 'half-open':
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def format(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'failure_threshold': self.failure_threshold,
+        }
+
+
+class ResponseCache:
+    """
+        last good response of each read request, keeping the max_entries
+        most recently used ones
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, response):
+        with self.lock:
+            self.entries[key] = (response.get_data(), response.mimetype,
+                                 time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def start_refresh(self, key):
+        """
+            return False if a refresh of key is already running
+        """
+        with self.lock:
+            if key in self.refreshing:
+                return False
+            self.refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self.lock:
+            self.refreshing.discard(key)
+
+    def format(self):
+        now = time.monotonic()
+        with self.lock:
+            ages = [now - entry[2] for entry in self.entries.values()]
+        return {
+            'entries': len(ages),
+            'max_entries': self.max_entries,
+            'max_age': round(max(ages), 3) if ages else None,
+        }
+
+
+def stale_while_revalidate(cache, breaker, cache_key):
+    """
+        decorator for read routes: run the view with a query deadline, and
+        when the database fails or the circuit breaker is open answer with
+        the last good response (marked stale) and refresh it in the
+        background. Without a cached response the error is a 503.
+        cache_key(request) names the cached response of a request.
+    """
+    def decorator(view):
+
+        def fetch(key, *args, **kwargs):
+            deadline = current_app.config.get('QUERY_DEADLINE')
+            try:
+                if deadline:
+                    set_query_deadline(deadline)
+                response = make_response(view(*args, **kwargs))
+            except HTTPException:
+                # the database answered, the request itself is wrong
+                breaker.record_success()
+                raise
+            except SQLAlchemyError:
+                # includes the query deadline being hit
+                breaker.record_failure()
+                db.session.rollback()
+                raise
+            except Exception:
+                # a bug in the view says nothing about the database, but a
+                # half-open probe must still settle the breaker state
+                breaker.record_error()
+                db.session.rollback()
+                raise
+            finally:
+                if deadline:
+                    clear_query_deadline()
+            breaker.record_success()
+            if response.status_code == 200:
+                cache.set(key, response)
+            return response
+
+        def refresh(app, key, path, headers, *args, **kwargs):
+            try:
+                with app.test_request_context(path, headers=headers):
+                    if breaker.allow():
+                        try:
+                            fetch(key, *args, **kwargs)
+                        except Exception:
+                            # fetch already recorded the outcome
+                            pass
+                        finally:
+                            db.session.remove()
+            finally:
+                cache.end_refresh(key)
+
+        def serve_stale(key, *args, **kwargs):
+            entry = cache.get(key)
+            if entry is None:
+                abort(503)
+            if cache.start_refresh(key):
+                headers = {'Accept': request.headers.get('Accept', '*/*')}
+                threading.Thread(
+                    target=refresh,
+                    args=(current_app._get_current_object(), key,
+                          request.full_path, headers) + args,
+                    kwargs=kwargs, daemon=True).start()
+            data, mimetype, stored_at = entry
+            response = make_response(data)
+            response.mimetype = mimetype
+            response.headers['Age'] = str(int(time.monotonic() - stored_at))
+            response.headers['Warning'] = '110 - "Response is Stale"'
+            response.headers['X-Cache'] = 'stale'
+            return response
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = cache_key(request)
+            if not breaker.allow():
+                return serve_stale(key, *args, **kwargs)
+            try:
+                return fetch(key, *args, **kwargs)
+            except SQLAlchemyError:
+                return serve_stale(key, *args, **kwargs)
+
+        return wrapper
+    return decorator
@@ -1,13 +1,48 @@
+import io
+import math
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+import re
+import time
+from sqlalchemy import Column, String, Integer, Index, create_engine, func, \
+    text, inspect, tuple_, false
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.dialects import postgresql, sqlite
 from flask_sqlalchemy import SQLAlchemy
 # import json
 from flask_migrate import Migrate
 
 
-database_name = 'trivia'
-database_path = 'postgresql://{}/{}'.format(
-    'postgres:oex@localhost:5432', database_name)
+# storage backend profiles: a sqlite file, an in-memory sqlite database
+# shared by all connections of the process, or postgres
+DATABASE_PROFILES = ('postgres', 'sqlite', 'memory')
+
+database_name = os.environ.get('DB_NAME', 'trivia')
+
+
+def database_path_for(profile):
+    """
+        database url of a storage backend profile, postgres credentials
+        and the sqlite file are read from the environment
+    """
+    if profile == 'memory':
+        return 'sqlite://'
+    if profile == 'sqlite':
+        return 'sqlite:///{}'.format(os.environ.get(
+            'SQLITE_PATH',
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         database_name + '.db')))
+    if profile == 'postgres':
+        return 'postgresql://{}:{}@{}/{}'.format(
+            os.environ.get('DB_USER', 'postgres'),
+            os.environ.get('DB_PASSWORD', ''),
+            os.environ.get('DB_HOST', 'localhost:5432'),
+            database_name)
+    raise ValueError('unknown database profile: {}'.format(profile))
+
+
+# DATABASE_URL wins over the profile selected with DB_PROFILE
+database_path = os.environ.get('DATABASE_URL') or database_path_for(
+    os.environ.get('DB_PROFILE', 'postgres'))
 
 db = SQLAlchemy()
 
@@ -18,12 +53,91 @@ def setup_db(app, database_path=database_path):
     """
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if database_path in ('sqlite://', 'sqlite:///:memory:'):
+        # every connection would get its own empty in-memory database,
+        # so share a single connection between threads
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            'poolclass': StaticPool,
+            'connect_args': {'check_same_thread': False},
+        }
+    elif database_path.startswith('postgresql') and \
+            app.config.get('QUERY_DEADLINE'):
+        # statement_timeout does not cover connecting, bound it as well
+        # (libpq counts whole seconds)
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            'connect_args': {'connect_timeout': max(
+                2, int(math.ceil(app.config['QUERY_DEADLINE'])))},
+        }
     db.app = app
     db.init_app(app)
     # create all tables models
     db.create_all()
+    # create_all skips existing tables, so add the listing indexes to
+    # databases loaded from trivia.psql as well
+    for index in Question.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
     # manage migrations and structures changes
     migrate = Migrate(app, db)
+    # summaries of a database loaded with psql start empty
+    seed_stats()
+
+
+def _copy_value(field):
+    """
+        decode a field of a COPY ... FROM stdin block (text format)
+    """
+    if field == '\\N':
+        return None
+    replacements = {'\\\\': '\\', '\\t': '\t', '\\n': '\n', '\\r': '\r'}
+    return re.sub(r'\\[\\tnr]', lambda match: replacements[match.group()],
+                  field)
+
+
+def load_psql_dump(path):
+    """
+        bulk load the data blocks of a pg_dump file (like trivia.psql) into
+        the current database, with COPY on postgres and batched inserts on
+        sqlite. The tables must exist and be empty.
+    """
+    with open(path, encoding='utf-8') as dump:
+        lines = iter(dump.read().splitlines())
+
+    connection = db.session.connection()
+    for line in lines:
+        match = re.match(r'COPY (?:\w+\.)?(\w+) \(([^)]*)\) FROM stdin;', line)
+        if match is None:
+            continue
+        table = db.metadata.tables[match.group(1)]
+        columns = [column.strip() for column in match.group(2).split(',')]
+        block = []
+        for row in lines:
+            if row == '\\.':
+                break
+            block.append(row)
+
+        if db.engine.dialect.name == 'postgresql':
+            cursor = connection.connection.cursor()
+            cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(
+                table.name, ', '.join(columns)),
+                io.StringIO('\n'.join(block) + '\n'))
+            # keep the id sequence after the loaded ids
+            connection.execute(text(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "(SELECT MAX(id) FROM {0}))".format(table.name)))
+        else:
+            types = [table.c[column].type.python_type for column in columns]
+            rows = []
+            for row in block:
+                values = [_copy_value(field) for field in row.split('\t')]
+                rows.append({
+                    column: value if value is None else kind(value)
+                    for column, kind, value in zip(columns, types, values)
+                })
+            if rows:
+                connection.execute(table.insert(), rows)
+
+    db.session.commit()
+    refresh_stats()
 
 
 """
@@ -32,13 +146,30 @@ Question
 """
 
 
+# sort options of Question.filtered(), each one backed by an index
+QUESTION_SORTS = ('id', '-id', 'difficulty', '-difficulty')
+# most UNION ALL branches a filtered listing can expand to
+MAX_FILTER_BRANCHES = 100
+
+
 class Question(db.Model):
     __tablename__ = 'questions'
+    # composite indexes backing every branch of Question.filtered():
+    # category (+ difficulty), difficulty and category alone, each one
+    # followed by id for the cursor and the order, the unfiltered listing
+    # uses the primary key
+    __table_args__ = (
+        Index('ix_questions_category_difficulty_id',
+              'category', 'difficulty', 'id'),
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_difficulty_id', 'difficulty', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    # integer like the categories.id it references in trivia.psql
+    category = Column(Integer)
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -49,15 +180,87 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
+        # keep the statistics summary in the same transaction
+        QuestionStat.bump(self.category, self.difficulty, 1)
         db.session.commit()
 
     def update(self):
+        # move the question to its new statistics counter, the stored
+        # values are read without flushing the pending changes
+        with db.session.no_autoflush:
+            stored = db.session.query(
+                Question.category, Question.difficulty).filter(
+                    Question.id == self.id).one_or_none()
+        if stored is not None:
+            QuestionStat.bump(stored.category, stored.difficulty, -1)
+            QuestionStat.bump(self.category, self.difficulty, 1)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        QuestionStat.bump(self.category, self.difficulty, -1)
         db.session.commit()
 
+    @classmethod
+    def filtered(cls, categories=None, min_difficulty=None,
+                 max_difficulty=None, after_id=None, after_difficulty=None,
+                 sort='id'):
+        """
+            build a query over questions filtered by a set of categories and
+            a difficulty range, ordered by one of QUESTION_SORTS and starting
+            after a cursor: the id of the last question of the previous page,
+            plus its difficulty for the difficulty sorts
+        """
+        if sort not in QUESTION_SORTS:
+            raise ValueError('unknown sort: {}'.format(sort))
+        descending = sort.startswith('-')
+        by_difficulty = sort.lstrip('-') == 'difficulty'
+        if (after_difficulty is not None) != \
+                (by_difficulty and after_id is not None):
+            raise ValueError('the cursor does not match the sort')
+
+        # an index returns rows in (difficulty, id) or id order for a single
+        # category and, for the id sorts, a single difficulty. Multi-valued
+        # filters are split into one branch per value and the ordered
+        # branches are merged with UNION ALL instead of sorted.
+        branches = [[cls.category == int(category)]
+                    for category in sorted(set(categories or ()))] or [[]]
+        difficulty_range = []
+        if min_difficulty is not None:
+            difficulty_range.append(cls.difficulty >= min_difficulty)
+        if max_difficulty is not None:
+            difficulty_range.append(cls.difficulty <= max_difficulty)
+        if difficulty_range and not by_difficulty:
+            # one branch per difficulty actually stored in the range, read
+            # from the difficulty index
+            levels = [level for level, in db.session.query(
+                cls.difficulty).filter(*difficulty_range).distinct()]
+            branches = [branch + [cls.difficulty == level]
+                        for branch in branches for level in levels]
+        else:
+            branches = [branch + difficulty_range for branch in branches]
+        if not branches:
+            return cls.query.filter(false())
+        if len(branches) > MAX_FILTER_BRANCHES:
+            raise ValueError('too many categories')
+
+        if after_id is not None:
+            cursor = tuple_(cls.difficulty, cls.id) if by_difficulty \
+                else cls.id
+            last = (after_difficulty, after_id) if by_difficulty \
+                else after_id
+            after = cursor < last if descending else cursor > last
+            branches = [branch + [after] for branch in branches]
+
+        queries = [cls.query.filter(*branch) for branch in branches]
+        query = queries[0].union_all(*queries[1:]) if len(queries) > 1 \
+            else queries[0]
+
+        order = [cls.difficulty, cls.id] if by_difficulty else [cls.id]
+        if descending:
+            order = [column.desc() for column in order]
+        return query.order_by(*order)
+
     def format(self):
         return {
             'id': self.id,
@@ -117,6 +320,8 @@ class User(db.Model):
 
     def insert(self):
         db.session.add(self)
+        # keep the statistics summary in the same transaction
+        ScoreStat.bump(self.score, 1)
         db.session.commit()
 
     def update(self):
@@ -124,12 +329,18 @@ class User(db.Model):
 
     def delete(self):
         db.session.delete(self)
+        ScoreStat.bump(self.score, -1)
         db.session.commit()
 
     def add_score(self, score):
-        self.score += score
+        self.initialize_score(self.score + score)
 
     def initialize_score(self, score):
+        # saved players move to their new score histogram bucket, new ones
+        # are counted by insert()
+        if inspect(self).persistent:
+            ScoreStat.bump(self.score, -1)
+            ScoreStat.bump(score, 1)
         self.score = score
 
     def format(self):
@@ -138,3 +349,186 @@ class User(db.Model):
             'username': self.username,
             'score': self.score,
         }
+
+
+def explain_query(query):
+    """
+        return the query plan of a query as text, used to check that the
+        filtered listings are served by an index
+    """
+    statement = query.statement.compile(
+        dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+    if db.engine.dialect.name == 'sqlite':
+        rows = db.session.execute(text('EXPLAIN QUERY PLAN {}'.format(
+            statement))).fetchall()
+        return '\n'.join(row[-1] for row in rows)
+    # on small tables postgres prefers sequential scans, disable them in a
+    # savepoint to see which index the planner would pick, rolling back the
+    # savepoint restores the setting and keeps the caller's session state
+    savepoint = db.session.begin_nested()
+    try:
+        db.session.execute(text('SET LOCAL enable_seqscan = off'))
+        rows = db.session.execute(text('EXPLAIN {}'.format(
+            statement))).fetchall()
+    finally:
+        savepoint.rollback()
+    return '\n'.join(row[0] for row in rows)
+
+
+def set_query_deadline(seconds):
+    """
+        make the queries of the current transaction fail once they run for
+        longer than seconds (statement_timeout on postgres, a progress
+        handler interrupting the query on sqlite)
+    """
+    connection = db.session.connection()
+    if db.engine.dialect.name == 'postgresql':
+        connection.execute(text('SET LOCAL statement_timeout = {}'.format(
+            int(seconds * 1000))))
+    elif db.engine.dialect.name == 'sqlite':
+        deadline = time.monotonic() + seconds
+        connection.connection.set_progress_handler(
+            lambda: time.monotonic() > deadline, 1000)
+
+
+def clear_query_deadline():
+    """
+        remove the sqlite progress handler installed by set_query_deadline
+        (the postgres timeout ends with the transaction)
+    """
+    if db.engine.dialect.name == 'sqlite':
+        db.session.connection().connection.set_progress_handler(None, 0)
+
+
+# ----------------------------------------------------------------------------#
+# Statistics summaries: one row per (category, difficulty) and one row per
+# score, kept up to date by the Question and User methods so the /stats
+# endpoint never has to scan the questions or users tables
+# ----------------------------------------------------------------------------#
+def _bump_count(model, delta, **key):
+    """
+        add delta to the count column of the summary row with the given key,
+        in a single upsert so concurrent writers never lose an update
+    """
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' \
+        else sqlite
+    table = model.__table__
+    statement = dialect.insert(table).values(count=delta, **key)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=list(key), set_={'count': table.c.count + delta}))
+
+
+class QuestionStat(db.Model):
+    __tablename__ = 'question_stats'
+
+    category = Column(Integer, primary_key=True)
+    difficulty = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, category, difficulty, count=0):
+        self.category = category
+        self.difficulty = difficulty
+        self.count = count
+
+    @classmethod
+    def bump(cls, category, difficulty, delta):
+        """
+            add delta to the counter of the given category and difficulty
+        """
+        _bump_count(cls, delta, category=int(category or 0),
+                    difficulty=int(difficulty or 0))
+
+    def format(self):
+        return {
+            'category': self.category,
+            'difficulty': self.difficulty,
+            'count': self.count,
+        }
+
+
+class ScoreStat(db.Model):
+    __tablename__ = 'score_stats'
+
+    score = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, score, count=0):
+        self.score = score
+        self.count = count
+
+    @classmethod
+    def bump(cls, score, delta):
+        """
+            add delta to the number of players having the given score
+        """
+        _bump_count(cls, delta, score=int(score or 0))
+
+    def format(self):
+        return {
+            'score': self.score,
+            'count': self.count,
+        }
+
+
+def _summary_rows():
+    """
+        question and score summary rows computed from the questions and
+        users tables
+    """
+    question_counts = {}
+    for category, difficulty, count in db.session.query(
+            Question.category, Question.difficulty, func.count(Question.id)
+    ).group_by(Question.category, Question.difficulty):
+        key = (int(category or 0), int(difficulty or 0))
+        question_counts[key] = question_counts.get(key, 0) + count
+
+    score_counts = {}
+    for score, count in db.session.query(
+            User.score, func.count(User.id)).group_by(User.score):
+        score_counts[int(score or 0)] = \
+            score_counts.get(int(score or 0), 0) + count
+
+    return ([{'category': category, 'difficulty': difficulty, 'count': count}
+             for (category, difficulty), count in question_counts.items()],
+            [{'score': score, 'count': count}
+             for score, count in score_counts.items()])
+
+
+def _insert_summary(model, rows):
+    """
+        insert summary rows, leaving the rows that already exist untouched
+    """
+    if not rows:
+        return
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' \
+        else sqlite
+    db.session.execute(
+        dialect.insert(model.__table__).values(rows).on_conflict_do_nothing())
+
+
+def seed_stats():
+    """
+        fill the statistics summaries when they are empty while the source
+        tables are not, e.g. on a database loaded with psql (run by
+        setup_db, safe when several workers start together)
+    """
+    question_rows, score_rows = _summary_rows()
+    if QuestionStat.query.first() is None:
+        _insert_summary(QuestionStat, question_rows)
+    if ScoreStat.query.first() is None:
+        _insert_summary(ScoreStat, score_rows)
+    db.session.commit()
+
+
+def refresh_stats():
+    """
+        rebuild the statistics summaries from the questions and users tables
+        (run by load_psql_dump and 'flask refresh-stats', schedule the
+        command to repair any drift)
+    """
+    question_rows, score_rows = _summary_rows()
+    QuestionStat.query.delete()
+    ScoreStat.query.delete()
+    _insert_summary(QuestionStat, question_rows)
+    _insert_summary(ScoreStat, score_rows)
+    db.session.commit()
@@ -1,10 +1,16 @@
 import os
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import gzip
+import itertools
+from unittest import mock
+from sqlalchemy.exc import OperationalError
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.formats import msgpack, COLUMNAR_MIMETYPE, MSGPACK_MIMETYPE, \
+    QUESTION_FIELDS
+from models import db, load_psql_dump, seed_stats, Question, Category, \
+    User, QuestionStat, explain_query, QUESTION_SORTS
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -12,23 +18,34 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        # storage backend of the tests: 'memory' (default), 'sqlite' or
+        # 'postgres' (set DB_NAME=trivia_test and load trivia.psql first)
+        self.database_profile = os.environ.get('TEST_DB_PROFILE', 'memory')
+        self.db = db
+        self.app = self.create_test_app()
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgresql://postgres:oex@{}/{}".format(
-            'localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
 
+    def create_test_app(self, **config):
+        """Create an app on the test database with extra config."""
+        config['DB_PROFILE'] = self.database_profile
+        app = create_app(config)
         # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+        with app.app_context():
+            if self.database_profile != 'postgres':
+                # fresh copy of the sample data for every test
+                self.db.drop_all()
+                self.db.create_all()
+                load_psql_dump(os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    'trivia.psql'))
+        return app
 
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        with self.app.app_context():
+            self.db.session.remove()
+            if self.database_profile == 'sqlite':
+                self.db.drop_all()
 
     """
     TODO
@@ -143,6 +160,97 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
 
+# ---------------------------------------#
+# test filtered questions
+# ---------------------------------------#
+    def test_filtered_questions(self):
+        res = self.client().get(
+            '/questions/filter?categories=1,2&min_difficulty=2&max_difficulty=4')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['questions']))
+        for question in data['questions']:
+            self.assertIn(int(question['category']), (1, 2))
+            self.assertTrue(2 <= question['difficulty'] <= 4)
+
+    def test_filtered_questions_cursor(self):
+        res = self.client().get('/questions/filter?sort=difficulty')
+        first_page = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(first_page['next_cursor'])
+
+        res = self.client().get('/questions/filter?sort=difficulty&after={}'
+                                .format(first_page['next_cursor']))
+        second_page = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        last = first_page['questions'][-1]
+        for question in second_page['questions']:
+            self.assertGreater((question['difficulty'], question['id']),
+                               (last['difficulty'], last['id']))
+
+    def test_filtered_questions_bad_sort(self):
+        res = self.client().get('/questions/filter?sort=answer')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_filtered_questions_cursor_after_delete(self):
+        res = self.client().get('/questions/filter?sort=difficulty')
+        first_page = json.loads(res.data)
+        last = first_page['questions'][-1]
+        self.client().delete('/questions/{}'.format(last['id']))
+
+        res = self.client().get('/questions/filter?sort=difficulty&after={}'
+                                .format(first_page['next_cursor']))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data['questions']))
+
+    def test_filtered_questions_same_rows_for_every_sort(self):
+        with self.app.app_context():
+            Question(question='what is the hardest question?', answer='42',
+                     category=1, difficulty=7).insert()
+            expected = None
+            for sort in QUESTION_SORTS:
+                ids = sorted(question.id for question in Question.filtered(
+                    categories=[1, 2], min_difficulty=2, sort=sort))
+                if expected is None:
+                    expected = ids
+                self.assertEqual(ids, expected, sort)
+            self.assertEqual(
+                len(expected),
+                Question.query.filter(Question.category.in_([1, 2]),
+                                      Question.difficulty >= 2).count())
+
+    def test_filtered_questions_use_index(self):
+        category_sets = [None, [1], [1, 2]]
+        difficulty_ranges = [(None, None), (3, None), (None, 3), (2, 4)]
+        combinations = itertools.product(
+            category_sets, difficulty_ranges, (False, True), QUESTION_SORTS)
+        with self.app.app_context():
+            for categories, (low, high), cursor, sort in combinations:
+                filters = dict(categories=categories, min_difficulty=low,
+                               max_difficulty=high, sort=sort)
+                if cursor:
+                    filters['after_id'] = 10
+                    if sort.lstrip('-') == 'difficulty':
+                        filters['after_difficulty'] = 3
+                plan = explain_query(Question.filtered(**filters))
+                # no sort step, rows come from the indexes in order
+                self.assertNotIn('TEMP B-TREE', plan, filters)
+                self.assertNotIn('Sort Key', plan, filters)
+                # no table scan, and on postgres every condition is an
+                # index condition rather than a filter on scanned rows
+                self.assertNotIn('Seq Scan', plan, filters)
+                self.assertNotIn('Filter:', plan, filters)
+                if categories or low or high or cursor:
+                    self.assertNotRegex(
+                        plan, r'(?m)^SCAN (TABLE )?questions\b', filters)
+                    self.assertNotRegex(
+                        plan, r'Index Scan( Backward)? using questions_pkey'
+                        r' on questions[^\n]*\n(?!\s+Index Cond)', filters)
+
 # ---------------------------------------#
 # test quiz game
 # ---------------------------------------#
@@ -163,6 +271,38 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['question']['category'], 3)
 
+    def test_quiz_difficulty(self):
+        res = self.client().post('/quizzes',
+                                 json={'previous_questions': [],
+                                       'quiz_category':
+                                       {'id': '1', 'type': 'Science'},
+                                       'min_difficulty': 4})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['question']['difficulty'] >= 4)
+
+    def test_quiz_difficulty_as_string(self):
+        res = self.client().post('/quizzes',
+                                 json={'previous_questions': [],
+                                       'quiz_category':
+                                       {'id': '1', 'type': 'Science'},
+                                       'min_difficulty': '4',
+                                       'max_difficulty': '4'})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['difficulty'], 4)
+
+    def test_quiz_difficulty_unprocessable(self):
+        res = self.client().post('/quizzes',
+                                 json={'previous_questions': [],
+                                       'quiz_category':
+                                       {'id': '1', 'type': 'Science'},
+                                       'min_difficulty': 'hard'})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     def test_quiz_category_unprocessable(self):
         res = self.client().post('/quizzes',
                                  json={
@@ -175,6 +315,273 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'Unprocessable resource')
 
 
+# ---------------------------------------#
+# test statistics
+# ---------------------------------------#
+    def test_get_stats(self):
+        res = self.client().get('/stats')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['total_questions'])
+        self.assertTrue(len(data['questions_per_category']))
+        self.assertTrue(len(data['difficulty_distribution']))
+        self.assertEqual(data['total_questions'],
+                         sum(data['questions_per_category'].values()))
+
+    def test_stats_follow_new_question(self):
+        before = json.loads(self.client().get('/stats').data)
+        self.client().post('/questions', json={
+            'question': 'what is the capital of Tunisia?',
+            'answer': 'Tunis',
+            'difficulty': 1,
+            'category': 3
+        })
+        after = json.loads(self.client().get('/stats').data)
+        self.assertEqual(after['total_questions'],
+                         before['total_questions'] + 1)
+        self.assertEqual(after['questions_per_category']['3'],
+                         before['questions_per_category'].get('3', 0) + 1)
+
+
+    def test_stats_follow_deleted_question(self):
+        before = json.loads(self.client().get('/stats').data)
+        res = self.client().delete('/questions/20')
+        self.assertEqual(res.status_code, 200)
+        after = json.loads(self.client().get('/stats').data)
+        self.assertEqual(after['total_questions'],
+                         before['total_questions'] - 1)
+        self.assertEqual(after['questions_per_category']['1'],
+                         before['questions_per_category']['1'] - 1)
+        self.assertEqual(after['difficulty_distribution']['4'],
+                         before['difficulty_distribution']['4'] - 1)
+
+    def test_stats_follow_updated_question(self):
+        with self.app.app_context():
+            question = Question.query.get(20)
+            question.difficulty = 1
+            question.update()
+        data = json.loads(self.client().get('/stats').data)
+        with self.app.app_context():
+            self.assertEqual(data['difficulty_distribution']['1'],
+                             Question.query.filter_by(difficulty=1).count())
+            self.assertEqual(data['difficulty_distribution']['4'],
+                             Question.query.filter_by(difficulty=4).count())
+
+    def test_stats_score_histogram(self):
+        before = json.loads(self.client().get('/stats').data)
+        for score in (3, 5):
+            self.client().post('/quizzes', json={
+                'previous_questions': [],
+                'quiz_category': {'type': 'click', 'id': 0},
+                'num_correct': score,
+                'forceEnd': True
+            })
+        with self.app.app_context():
+            # a saved player moves to another histogram bucket
+            player = User(username='Scorer', score=0)
+            player.insert()
+            player.add_score(7)
+            player.update()
+
+        data = json.loads(self.client().get('/stats').data)
+        self.assertEqual(data['total_users'], before['total_users'] + 3)
+        for score in ('3', '5', '7'):
+            self.assertEqual(data['score_histogram'][score],
+                             before['score_histogram'].get(score, 0) + 1)
+        self.assertEqual(data['score_histogram'].get('0', 0),
+                         before['score_histogram'].get('0', 0))
+        histogram = data['score_histogram']
+        self.assertEqual(data['average_score'],
+                         sum(int(score) * count
+                             for score, count in histogram.items()) /
+                         sum(histogram.values()))
+
+    def test_stats_seeded_on_existing_database(self):
+        with self.app.app_context():
+            # summaries of a database loaded with psql start empty
+            QuestionStat.query.delete()
+            self.db.session.commit()
+            seed_stats()
+            # seeding again leaves existing summaries untouched
+            seed_stats()
+            total = Question.query.count()
+        data = json.loads(self.client().get('/stats').data)
+        self.assertEqual(data['total_questions'], total)
+
+
+# ---------------------------------------#
+# test graceful degradation
+# ---------------------------------------#
+    def database_down(self):
+        """patch the categories queries to fail like an unreachable database"""
+        query = mock.Mock()
+        query.all.side_effect = OperationalError(
+            'SELECT', {}, Exception('database is down'))
+        query.filter_by.return_value.one_or_none.side_effect = \
+            query.all.side_effect
+        return mock.patch.object(Category, 'query', query)
+
+    def test_stale_categories_when_database_fails(self):
+        fresh = self.client().get('/categories')
+        self.assertEqual(fresh.status_code, 200)
+
+        with self.database_down():
+            res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Cache'], 'stale')
+        self.assertIn('Age', res.headers)
+        self.assertEqual(data, json.loads(fresh.data))
+
+    def test_unavailable_without_cached_response(self):
+        with self.database_down():
+            res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Service unavailable')
+
+    def test_circuit_breaker_opens(self):
+        with self.database_down():
+            for attempt in range(5):
+                self.client().get('/categories/1/questions')
+            res = self.client().get('/metrics')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['circuit_breaker']['state'], 'open')
+
+        # the database is not queried while the breaker is open
+        res = self.client().get('/categories')
+        self.assertEqual(res.status_code, 503)
+
+    def test_metrics_cache_age(self):
+        self.client().get('/questions')
+        res = self.client().get('/metrics')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['circuit_breaker']['state'], 'closed')
+        self.assertEqual(data['cache']['entries'], 1)
+        self.assertGreaterEqual(data['cache']['max_age'], 0)
+
+    def test_cache_key_ignores_raw_client_input(self):
+        self.client().get('/questions')
+        self.client().get('/questions?page=1&utm=abc')
+        self.client().get('/questions',
+                          headers={'Accept': 'application/json, */*'})
+        data = json.loads(self.client().get('/metrics').data)
+        self.assertEqual(data['cache']['entries'], 1)
+
+    def test_cache_is_bounded(self):
+        client = self.create_test_app(CACHE_MAX_ENTRIES=2).test_client()
+        client.get('/questions?page=1')
+        client.get('/questions?page=2')
+        client.get('/categories')
+        data = json.loads(client.get('/metrics').data)
+        self.assertEqual(data['cache']['entries'], 2)
+        self.assertEqual(data['cache']['max_entries'], 2)
+
+    def view_bug(self):
+        """patch the categories queries to fail like a bug in the view"""
+        return mock.patch.object(Category, 'query', mock.Mock(
+            all=mock.Mock(side_effect=RuntimeError('bug'))))
+
+    def test_half_open_probe_settles_on_view_bug(self):
+        client = self.create_test_app(
+            BREAKER_FAILURE_THRESHOLD=1,
+            BREAKER_RESET_TIMEOUT=0).test_client()
+        with self.database_down():
+            client.get('/categories')
+        with self.view_bug():
+            res = client.get('/categories')
+        self.assertEqual(res.status_code, 500)
+        data = json.loads(client.get('/metrics').data)
+        # back to open, the bug is not counted as a database failure
+        self.assertEqual(data['circuit_breaker']['state'], 'open')
+        self.assertEqual(data['circuit_breaker']['failures'], 1)
+
+        # the next probe reaches the healthy database and closes it
+        res = client.get('/categories')
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(client.get('/metrics').data)
+        self.assertEqual(data['circuit_breaker']['state'], 'closed')
+
+    def test_view_bugs_do_not_open_breaker(self):
+        with self.view_bug():
+            for attempt in range(5):
+                res = self.client().get('/categories')
+                self.assertEqual(res.status_code, 500)
+        data = json.loads(self.client().get('/metrics').data)
+        self.assertEqual(data['circuit_breaker']['state'], 'closed')
+        self.assertEqual(data['circuit_breaker']['failures'], 0)
+
+        # the other read routes keep querying the database
+        res = self.client().get('/questions')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('X-Cache', res.headers)
+
+# ---------------------------------------#
+# test compact formats
+# ---------------------------------------#
+    def test_get_questions_columnar(self):
+        res = self.client().get('/questions',
+                                headers={'Accept': COLUMNAR_MIMETYPE})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, COLUMNAR_MIMETYPE)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['questions']['fields'], list(QUESTION_FIELDS))
+
+        # same questions as the plain JSON response
+        plain = json.loads(self.client().get('/questions').data)
+        self.assertEqual(data['total_questions'], plain['total_questions'])
+        self.assertEqual(
+            [dict(zip(data['questions']['fields'], row))
+             for row in data['questions']['rows']],
+            plain['questions'])
+
+    def test_questions_per_category_columnar(self):
+        res = self.client().get('/categories/1/questions',
+                                headers={'Accept': COLUMNAR_MIMETYPE})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['current_category'], 'Science')
+        category = QUESTION_FIELDS.index('category')
+        for row in data['questions']['rows']:
+            self.assertEqual(row[category], 1)
+
+    def test_columnar_matches_json_status(self):
+        for path in ('/questions', '/categories/1/questions'):
+            for page in (0, -1, 1, 99):
+                url = '{}?page={}'.format(path, page)
+                plain = self.client().get(url)
+                compact = self.client().get(
+                    url, headers={'Accept': COLUMNAR_MIMETYPE})
+                self.assertEqual(compact.status_code, plain.status_code, url)
+                if plain.status_code == 200:
+                    self.assertEqual(
+                        len(json.loads(compact.data)['questions']['rows']),
+                        len(json.loads(plain.data)['questions']), url)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_get_questions_msgpack(self):
+        res = self.client().get('/questions',
+                                headers={'Accept': MSGPACK_MIMETYPE})
+        data = msgpack.unpackb(res.data, strict_map_key=False)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, MSGPACK_MIMETYPE)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['questions']['rows']))
+
+    def test_get_questions_gzip(self):
+        res = self.client().get('/questions',
+                                headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(res.data))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(data['success'], True)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()